@@ -45,8 +45,8 @@ import glob
 import time
 import os
 import struct
-import binascii
 import traceback
+import zlib
 
 try:
     import magic
@@ -55,12 +55,6 @@ try:
 except (ImportError, AttributeError):
     have_magic = False
 
-try:
-    from intelhex import IntelHex
-    have_hex_support = True
-except ImportError:
-    have_hex_support = False
-
 # version
 __version__ = "2.1"
 
@@ -77,8 +71,11 @@ except ImportError:
     sys.exit(1)
 
 
-def mdebug(level, message, attr='\n'):
+def mdebug(level, message, *args, attr='\n'):
+    # message is only %-formatted with args once the level is enabled
     if QUIET >= level:
+        if args:
+            message = message % args
         print(message, end=attr, file=sys.stderr)
 
 # Takes chip IDs (obtained via Get ID command) to human-readable names
@@ -104,6 +101,80 @@ class CmdException(Exception):
     pass
 
 
+def _read_intel_hex(path):
+    """
+    Parse an Intel HEX file into a contiguous image
+
+    Each record is decoded with a single bytes.fromhex() call and copied into
+    the image with one slice assignment, so there is no per-byte Python work.
+    Gaps between records are padded with 0xFF, like erased flash. Malformed
+    records, unknown record types and overlapping data raise CmdException.
+
+    Parameters:
+        path -- A str with the path to the Intel HEX file.
+
+    Return:
+        A bytearray starting at the lowest data address in the file
+    """
+    records = []
+    base = 0
+    with open(path, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line[0] != ':':
+                    raise ValueError("missing ':'")
+                rec = bytes.fromhex(line[1:])
+                if len(rec) < 5 or len(rec) != rec[0] + 5:
+                    raise ValueError("bad record length")
+                if sum(rec) & 0xFF:
+                    raise ValueError("bad checksum")
+                if rec[3] > 0x05:
+                    raise ValueError("unknown record type 0x%02x" % rec[3])
+                if rec[3] == 0x01 and rec[0] != 0:
+                    raise ValueError("bad end of file record length")
+                if rec[3] in (0x02, 0x04) and rec[0] != 2:
+                    raise ValueError("bad address record length")
+                if rec[3] in (0x03, 0x05) and rec[0] != 4:
+                    raise ValueError("bad start address record length")
+            except ValueError as err:
+                raise CmdException("Invalid Intel Hex record at line %d: %s"
+                                   % (lineno, err))
+
+            rtype = rec[3]
+            if rtype == 0x00:  # data
+                records.append((base + ((rec[1] << 8) | rec[2]), rec[4:-1]))
+            elif rtype == 0x01:  # end of file
+                break
+            elif rtype == 0x02:  # extended segment address
+                base = ((rec[4] << 8) | rec[5]) << 4
+            elif rtype == 0x04:  # extended linear address
+                base = ((rec[4] << 8) | rec[5]) << 16
+            # 0x03 and 0x05 are start addresses, not needed for flashing
+
+    if not records:
+        return bytearray()
+
+    # Overlapping records mean a badly merged file, refuse it rather than
+    # letting one silently win (the CRC would still match the merged image)
+    records.sort(key=lambda record: record[0])
+    end = records[0][0]
+    for addr, data in records:
+        if addr < end:
+            raise CmdException("Invalid Intel Hex file: data overlaps at "
+                               "address 0x%08X" % addr)
+        end = addr + len(data)
+
+    start = records[0][0]
+    image = bytearray(b'\xff') * (end - start)
+    for addr, data in records:
+        image[addr - start:addr - start + len(data)] = data
+
+    return image
+
+
 class FirmwareFile(object):
     HEX_FILE_EXTENSIONS = ('hex', 'ihx', 'ihex')
 
@@ -113,22 +184,23 @@ class FirmwareFile(object):
 
         This class will try to guess the file type if python-magic is available.
 
-        If python-magic indicates a plain text file, and if IntelHex is
-        available, then the file will be treated as one of Intel HEX format.
+        If python-magic indicates a plain text file, then the file will be
+        treated as one of Intel HEX format.
 
         In all other cases, the file will be treated as a raw binary file.
 
-        In both cases, the file's contents are stored in bytes for subsequent
-        usage to program a device or to perform a crc check.
+        In both cases, the file's contents are exposed through bytes for
+        subsequent usage to program a device or to perform a crc check.
 
         Parameters:
             path -- A str with the path to the firmware file.
 
         Attributes:
-            bytes: A bytearray with firmware contents ready to send to the
+            bytes: A memoryview of the firmware contents ready to send to the
             device
         """
         self._crc32 = None
+        self._data = bytearray()
         firmware_is_hex = False
 
         if have_magic:
@@ -155,19 +227,17 @@ class FirmwareFile(object):
             mdebug(10, "Please see the readme for more details.")
 
         if firmware_is_hex:
-            if have_hex_support:
-                self.bytes = bytearray(IntelHex(path).tobinarray())
-                return
-            else:
-                error_str = "Firmware is Intel Hex, but the IntelHex library " \
-                            "could not be imported.\n" \
-                            "Install IntelHex in site-packages or program " \
-                            "your device with a raw binary (.bin) file.\n" \
-                            "Please see the readme for more details."
-                raise CmdException(error_str)
+            self._data = _read_intel_hex(path)
+            return
 
+        # Read into memory rather than mmap: images are at most 512 KiB, and
+        # a mapped file truncated or rewritten during a flash would SIGBUS.
         with open(path, 'rb') as f:
-            self.bytes = bytearray(f.read())
+            self._data = bytearray(f.read())
+
+    @property
+    def bytes(self):
+        return memoryview(self._data)
 
     def crc32(self):
         """
@@ -178,10 +248,30 @@ class FirmwareFile(object):
             returned by the ROM bootloader's COMMAND_CRC32
         """
         if self._crc32 is None:
-            self._crc32 = binascii.crc32(bytearray(self.bytes)) & 0xffffffff
+            self._crc32 = self.crc32_stream()
 
         return self._crc32
 
+    def crc32_stream(self, chunk=65536):
+        """
+        Fold the crc32 checksum over the firmware image chunk by chunk
+
+        The image is walked through a memoryview, so no slice is copied and
+        each chunk stays cache resident while it is being checksummed.
+
+        Parameters:
+            chunk -- Number of bytes folded into the checksum per step.
+
+        Return:
+            The firmware's CRC32, same value as crc32()
+        """
+        mv = self.bytes
+        crc = 0
+        for i in range(0, len(mv), chunk):
+            crc = zlib.crc32(mv[i:i + chunk], crc)
+
+        return crc & 0xffffffff
+
 
 class CommandInterface(object):
 
@@ -216,6 +306,15 @@ class CommandInterface(object):
 
         self.sp.open()
 
+        # Ask the tty driver to push received bytes immediately instead of
+        # batching them for up to 10 ms. Only Linux implements it, and not
+        # every driver supports it there.
+        if hasattr(self.sp, 'set_low_latency_mode'):
+            try:
+                self.sp.set_low_latency_mode(True)
+            except (IOError, ValueError, NotImplementedError):
+                mdebug(10, "Low latency mode not supported by %s" % aport)
+
     def invoke_bootloader(self, dtr_active_high=False, inverted=False):
         # Use the DTR and RTS lines to control bootloader and the !RESET pin.
         # This can automatically invoke the bootloader without the user
@@ -257,7 +356,12 @@ class CommandInterface(object):
 
     def _wait_for_ack(self, info="", timeout=1):
         stop = time.time() + timeout
+        # The reply is normally exactly 0x00 ACK/NACK, so ask for both bytes
+        # in one read and only fall back to byte-by-byte reads to skip any
+        # stray bytes in front of it. Never read past the ACK/NACK: a data
+        # packet may follow it.
         got = bytearray(2)
+        got += self._read(2)
         while got[-2] != 00 or got[-1] not in (CommandInterface.ACK_BYTE,
                                                CommandInterface.NACK_BYTE):
             got += self._read(1)
@@ -267,7 +371,7 @@ class CommandInterface(object):
 
         # Our bytearray's length is: 2 initial bytes + 2 bytes for the ACK/NACK
         # plus a possible N-4 additional (buffered) bytes
-        mdebug(10, "Got %d additional bytes before ACK/NACK" % (len(got) - 4,))
+        mdebug(10, "Got %d additional bytes before ACK/NACK", len(got) - 4)
 
         # wait for ask
         ask = got[-1]
@@ -277,11 +381,11 @@ class CommandInterface(object):
             return 1
         elif ask == CommandInterface.NACK_BYTE:
             # NACK
-            mdebug(10, "Target replied with a NACK during %s" % info)
+            mdebug(10, "Target replied with a NACK during %s", info)
             return 0
 
         # Unknown response
-        mdebug(10, "Unrecognised response 0x%x to %s" % (ask, info))
+        mdebug(10, "Unrecognised response 0x%x to %s", ask, info)
         return 0
 
     def _encode_addr(self, addr):
@@ -350,7 +454,7 @@ class CommandInterface(object):
         chks = got[1]  # rcv checksum
         data = bytearray(self._read(size - 2))  # rcv data
 
-        mdebug(10, "*** received %x bytes" % size)
+        mdebug(10, "*** received %x bytes", size)
         if chks == sum(data) & 0xFF:
             self.sendAck()
             return data
@@ -554,10 +658,12 @@ class CommandInterface(object):
         lng = len(data)+3
         # TODO: check total size of data!! max 252 bytes!
 
-        self._write(lng)  # send size
-        self._write((sum(bytearray(data))+cmd) & 0xFF)  # send checksum
-        self._write(cmd)  # send cmd
-        self._write(bytearray(data))  # send data
+        # The boot loader only accepts one packet in flight, so the ACK
+        # round trip can't be overlapped. Send the whole packet in a single
+        # write instead, so it leaves in one USB transfer rather than four.
+        packet = bytearray([lng, 0, cmd]) + data
+        packet[1] = (sum(packet[2:])) & 0xFF  # checksum over cmd + data
+        self._write(packet)
 
         mdebug(10, "*** Send Data (0x24)")
         if self._wait_for_ack("Send data (0x24)", 10):
@@ -581,16 +687,19 @@ class CommandInterface(object):
                 #                   ord(data[2]),ord(data[1]),ord(data[0]))
                 return data
 
-    def cmdMemReadCC26xx(self, addr):
+    def cmdMemReadCC26xx(self, addr, count=1):
         cmd = 0x2A
         lng = 9
 
+        if not 0 < count <= 63:  # boot loader max is 63 32-bit reads
+            raise ValueError("count must be between 1 and 63")
+
         self._write(lng)  # send length
-        self._write(self._calc_checks(cmd, addr, 2))  # send checksum
+        self._write(self._calc_checks(cmd, addr, 1 + count))  # send checksum
         self._write(cmd)  # send cmd
         self._write(self._encode_addr(addr))  # send addr
         self._write(1)  # send width, 4 bytes
-        self._write(1)  # send number of reads
+        self._write(count)  # send number of reads
 
         mdebug(10, "*** Mem Read (0x2A)")
         if self._wait_for_ack("Mem Read (0x2A)", 1):
@@ -625,7 +734,10 @@ class CommandInterface(object):
 
 # Complex commands section
 
-    def writeMemory(self, addr, data):
+    def writeMemory(self, addr, data, on_chunk=None):
+        # on_chunk, if given, is called with every packet sized slice of data
+        # in order, skipped 0xFF packets included, e.g. to fold a CRC32 over
+        # the image while it is being sent.
         lng = len(data)
         # amount of data bytes transferred per packet (theory: max 252 + 3)
         trsf_size = 248
@@ -646,26 +758,29 @@ class CommandInterface(object):
                                      "Do you want to continue?", "no")):
                     raise Exception('Aborted by user.')
 
-        mdebug(5, "Writing %(lng)d bytes starting at address 0x%(addr)08X" %
-               {'lng': lng, 'addr': addr})
+        mdebug(5, "Writing %d bytes starting at address 0x%08X", lng, addr)
 
         offs = 0
         addr_set = 0
 
         # check if amount of remaining data is less then packet size
         while lng > trsf_size:
+            chunk = data[offs:offs+trsf_size]
+            if on_chunk:
+                on_chunk(chunk)
+
             # skip packets filled with 0xFF
-            if data[offs:offs+trsf_size] != empty_packet:
+            if chunk != empty_packet:
                 if addr_set != 1:
                     # set starting address if not set
                     self.cmdDownload(addr, lng)
                     addr_set = 1
-                mdebug(5, " Write %(len)d bytes at 0x%(addr)08X"
-                       % {'addr': addr, 'len': trsf_size}, '\r')
+                mdebug(5, " Write %d bytes at 0x%08X", trsf_size, addr,
+                       attr='\r')
                 sys.stdout.flush()
 
                 # send next data packet
-                self.cmdSendData(data[offs:offs+trsf_size])
+                self.cmdSendData(chunk)
             else:   # skipped packet, address needs to be set
                 addr_set = 0
 
@@ -673,10 +788,12 @@ class CommandInterface(object):
             addr = addr + trsf_size
             lng = lng - trsf_size
 
-        mdebug(5, "Write %(len)d bytes at 0x%(addr)08X" % {'addr': addr,
-                                                           'len': lng})
+        mdebug(5, "Write %d bytes at 0x%08X", lng, addr)
+        chunk = data[offs:offs+lng]
+        if on_chunk:
+            on_chunk(chunk)
         self.cmdDownload(addr, lng)
-        return self.cmdSendData(data[offs:offs+lng])  # send last data packet
+        return self.cmdSendData(chunk)  # send last data packet
 
 
 class Chip(object):
@@ -686,6 +803,7 @@ class Chip(object):
         # Some defaults. The child can override.
         self.flash_start_addr = 0x00000000
         self.has_cmd_set_xosc = False
+        self.has_range_erase = False
         self.page_size = 2048
 
     def page_to_addr(self, pages):
@@ -695,6 +813,21 @@ class Chip(object):
                              int(page)*self.page_size)
         return addresses
 
+    def read_memory_bulk(self, addr, length):
+        # Generic fallback: one 4-byte read per command, collected into a
+        # single buffer. length must be a multiple of 4.
+        data = bytearray()
+        for offs in range(0, length, 4):
+            data += self.read_memory(addr + offs)
+        return data
+
+    def can_erase_range(self, addr, size):
+        # A range erase is only used for images below the last page, which
+        # holds the CCFG (boot loader backdoor). Anything reaching it gets a
+        # full erase so the CCFG is rewritten from the image.
+        return self.has_range_erase and (
+            addr + size <= self.flash_start_addr + self.size - self.page_size)
+
     def crc(self, address, size):
         return getattr(self.command_interface, self.crc_cmd)(address, size)
 
@@ -720,6 +853,7 @@ class CC2538(Chip):
         self.flash_start_addr = 0x00200000
         self.addr_ieee_address_secondary = 0x0027ffcc
         self.has_cmd_set_xosc = True
+        self.has_range_erase = True
         self.bootloader_dis_val = 0xefffffff
         self.crc_cmd = "cmdCRC32"
 
@@ -768,6 +902,17 @@ class CC2538(Chip):
         return self.command_interface.cmdEraseMemory(self.flash_start_addr,
                                                      self.size)
 
+    def erase_range(self, addr, size):
+        # COMMAND_ERASE takes any page aligned range, erase() is just the
+        # range covering the whole flash. Round out to whole pages.
+        start = addr - (addr - self.flash_start_addr) % self.page_size
+        end = addr + size
+        size = (end - start + self.page_size - 1) // self.page_size \
+            * self.page_size
+        mdebug(5, "Erasing %s bytes starting at address 0x%08X"
+               % (size, start))
+        return self.command_interface.cmdEraseMemory(start, size)
+
     def read_memory(self, addr):
         # CC2538's COMMAND_MEMORY_READ sends each 4-byte number in inverted
         # byte order compared to what's written on the device
@@ -913,6 +1058,19 @@ class CC26xx(Chip):
         # they are stored on the device
         return self.command_interface.cmdMemReadCC26xx(addr)
 
+    def read_memory_bulk(self, addr, length):
+        # CC26xx COMMAND_MEMORY_READ can return up to 63 words (252 bytes)
+        # per command. length must be a multiple of 4.
+        trsf_size = 252
+        data = bytearray()
+        for offs in range(0, length, trsf_size):
+            count = min(trsf_size, length - offs) >> 2
+            mdebug(5, " Read %d bytes at 0x%08X", count << 2, addr + offs,
+                   attr='\r')
+            data += self.command_interface.cmdMemReadCC26xx(addr + offs,
+                                                            count)
+        return data
+
 
 def query_yes_no(question, default="yes"):
     valid = {"yes": True,
@@ -1289,9 +1447,9 @@ if __name__ == "__main__":
                 for i in range(0, length >> 2):
                     # reading 4 bytes at a time
                     rdata = device.read_memory(conf['address'] + (i * 4))
-                    mdebug(5, " 0x%x: 0x%02x%02x%02x%02x"
-                           % (conf['address'] + (i * 4), rdata[0], rdata[1],
-                              rdata[2], rdata[3]), '\r')
+                    mdebug(5, " 0x%x: 0x%02x%02x%02x%02x",
+                           conf['address'] + (i * 4), rdata[0], rdata[1],
+                           rdata[2], rdata[3], attr='\r')
                     f.write(rdata)
                 f.close()
             mdebug(5, "    Read done                                ")
@@ -1,7 +1,5 @@
 import click
 
-from dongle import utils
-
 
 @click.group()
 def run():
@@ -15,6 +13,9 @@ def run():
     help="firmware path ready be flash.)",
 )
 def boot(firmware: str):
+    # imported here so --help doesn't load loguru, pyserial and the bsl
+    from dongle import utils
+
     utils.boot(firmware)
 
 
@@ -27,6 +28,8 @@ def boot(firmware: str):
     help="port of flash dev.(defalut: /dev/ttyUSB0)",
 )
 def flash(firmware: str, port: str):
+    from dongle import utils
+
     utils.flash_firmware(port=port, firmware_path=firmware)
 
 
@@ -1,7 +1,11 @@
+import functools
 import os
 import struct
 import time
 import traceback
+import zlib
+from dataclasses import dataclass
+from typing import Optional, Union
 
 from loguru import logger
 
@@ -18,40 +22,124 @@ from dongle.cc2538_bsl import (
     QUIET,
 )
 
-mode = rstpin = bslpin = None
-try:
-    import RPi.GPIO as GPIO
+# 64 bit IEEE address, big endian for display, little endian on the device
+_BE_Q = struct.Struct(">Q")
+_LE_Q = struct.Struct("<Q")
 
-    if GPIO.RPI_INFO["TYPE"] != "Jetson Nano":
-        logger.info("rpi")
 
-        mode = GPIO.BCM
-        rstpin, bslpin = 4, 22
-    else:
-        logger.info("nano")
+@dataclass
+class FlashConf:
+    """flash_firmware options, same meaning as the cc2538_bsl conf keys"""
 
-        import Jetson.GPIO as GPIO
-        mode = GPIO.BOARD
-        rstpin, bslpin = 7, 15
-except (ImportError, RuntimeError, ModuleNotFoundError) as e:
-    # logger.debug(e)
-    import fake_rpigpio.utils
+    port: str  # dev
+    baud: int = 115200
+    force_speed: int = 0
+    address: Optional[int] = None
+    force: int = 0
+    erase: int = 1
+    write: int = 1
+    erase_page: Union[int, str] = 0
+    verify: int = 1
+    read: int = 0
+    len: int = 0x80000
+    fname: str = ""
+    ieee_address: Union[int, str] = 0
+    bootloader_active_high: bool = False
+    bootloader_invert_lines: bool = False
+    disable_bootloader: int = 0
 
-    fake_rpigpio.utils.install()
-    from fake_rpigpio.RPi import GPIO
 
+# how long each boot pin level is held, about 300ms
+_HOLD = 0.3
 
-def get_dev():
+
+@functools.lru_cache(maxsize=1)
+def _load_gpio():
+    """Probe the board and import its GPIO module on first use.
+
+    Returns:
+        (GPIO, mode, rstpin, bslpin)
+    """
+    try:
+        import RPi.GPIO as GPIO
+
+        if GPIO.RPI_INFO["TYPE"] != "Jetson Nano":
+            logger.info("rpi")
+
+            return GPIO, GPIO.BCM, 4, 22
+        else:
+            logger.info("nano")
+
+            import Jetson.GPIO as GPIO
+            return GPIO, GPIO.BOARD, 7, 15
+    except (ImportError, RuntimeError, ModuleNotFoundError) as e:
+        # logger.debug(e)
+        import fake_rpigpio.utils
+
+        fake_rpigpio.utils.install()
+        from fake_rpigpio.RPi import GPIO
+
+        return GPIO, None, None, None
+
+
+@functools.lru_cache(maxsize=1)
+def _pin_levels():
+    """pin levels for each boot phase, in GPIO.output() argument form
+
+    Returns:
+        (flash_mode, run_mode, reset_release)
+    """
+    GPIO, _, rstpin, bslpin = _load_gpio()
+    return (
+        ([bslpin, rstpin], GPIO.LOW),
+        ([bslpin, rstpin], (GPIO.HIGH, GPIO.LOW)),
+        (rstpin, GPIO.HIGH),
+    )
+
+
+def _wait_until(deadline: float):
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _dev_exists(dev: str) -> bool:
+    try:
+        os.stat(dev)
+    except OSError:
+        return False
+    return True
+
+
+def _compute_dev():
+    GPIO = _load_gpio()[0]
     dev_type = getattr(GPIO, "RPI_INFO", {}).get("TYPE", "unknow")
     devs = {"Pi 3 Model B": "ttyS0", "Jetson Nano": "ttyTHS1"}
     dev = f"/dev/ttyUSB0"
 
-    if dev_type in devs.keys() and not os.path.exists(dev):
+    if dev_type in devs.keys() and not _dev_exists(dev):
         dev = f"/dev/{devs[dev_type]}"
 
     return dev
 
 
+@functools.lru_cache(maxsize=1)
+def _cached_dev():
+    return _compute_dev()
+
+
+def get_dev():
+    """dongle serial dev, resolved once on first call.
+
+    Set DONGLE_FORCE_DEV to probe again on every call, e.g. when the usb
+    dongle is plugged in after startup.
+    """
+    if os.environ.get("DONGLE_FORCE_DEV"):
+        return _compute_dev()
+
+    return _cached_dev()
+
+
 def boot(firmware=None, exit_=False) -> bool:
     """
     dongle startup.
@@ -63,29 +151,31 @@ def boot(firmware=None, exit_=False) -> bool:
     logger.info(f"dongle dev: {dev}")
     if "ttyUSB0" not in dev:
         # GPIO control, enter flash mode and flash firmware, or reset to run mode
+        GPIO, mode, rstpin, bslpin = _load_gpio()
+        flash_mode, run_mode, reset_release = _pin_levels()
         GPIO.setwarnings(False)
         GPIO.setmode(mode)
         GPIO.setup([bslpin, rstpin], GPIO.OUT, initial=GPIO.HIGH)
 
         try:
             if firmware:
+                # enter flash mode, logging runs inside the hold time
+                GPIO.output(*flash_mode)
+                deadline = time.monotonic() + _HOLD
                 logger.info("dongle mode: flash")
-
-                # enter flash mode
-                GPIO.output([bslpin, rstpin], GPIO.LOW)
-                time.sleep(0.3)  # sleep for about 300ms
-                GPIO.output(rstpin, GPIO.HIGH)
-                time.sleep(0.3)
+                _wait_until(deadline)
+                GPIO.output(*reset_release)
+                time.sleep(_HOLD)
 
                 result = flash_firmware(port=dev, firmware_path=firmware, exit_=exit_)
             else:
                 logger.info("dongle mode: run")
 
             # reset to run mode
-            GPIO.output([bslpin, rstpin], (GPIO.HIGH, GPIO.LOW))
-            time.sleep(0.3)  # sleep for about 300ms
-            GPIO.output(rstpin, GPIO.HIGH)
-            time.sleep(0.3)  # sleep for about 300ms
+            GPIO.output(*run_mode)
+            time.sleep(_HOLD)
+            GPIO.output(*reset_release)
+            time.sleep(_HOLD)
 
         except Exception as e:
             logger.error(e)
@@ -111,35 +201,19 @@ def flash_firmware(port: str, firmware_path: str, exit_ = True) -> bool:
         CmdException: _description_
     """
     logger.info("flash firmware.")
-    conf = {
-        "port": port,  # dev
-        "baud": 115200,
-        "force_speed": 0,
-        "address": None,
-        "force": 0,
-        "erase": 1,
-        "write": 1,
-        "erase_page": 0,
-        "verify": 1,
-        "read": 0,
-        "len": 0x80000,
-        "fname": "",
-        "ieee_address": 0,
-        "bootloader_active_high": False,
-        "bootloader_invert_lines": False,
-        "disable-bootloader": 0,
-    }
+    conf = FlashConf(port=port)
     try:
         cmd = CommandInterface()
-        cmd.open(conf["port"], conf["baud"])
+        cmd.open(conf.port, conf.baud)
         cmd.invoke_bootloader(
-            conf["bootloader_active_high"], conf["bootloader_invert_lines"]
+            conf.bootloader_active_high, conf.bootloader_invert_lines
         )
 
-        mdebug(5, f"Opening port {conf['port']}, baud {conf['baud']}")
-        if conf["write"] or conf["verify"]:
+        mdebug(5, f"Opening port {conf.port}, baud {conf.baud}")
+        if conf.write or conf.verify:
             mdebug(5, "Reading data from %s" % firmware_path)
             firmware = FirmwareFile(firmware_path)
+            firmware_bytes = firmware.bytes
 
             mdebug(5, "Connecting to target...")
 
@@ -164,18 +238,18 @@ def flash_firmware(port: str, firmware_path: str, exit_ = True) -> bool:
             device = CC2538(cmd)
 
         # Choose a good default address unless the user specified -a
-        if conf["address"] is None:
-            conf["address"] = device.flash_start_addr
+        if conf.address is None:
+            conf.address = device.flash_start_addr
 
-        if conf["force_speed"] != 1 and device.has_cmd_set_xosc:
+        if conf.force_speed != 1 and device.has_cmd_set_xosc:
             if cmd.cmdSetXOsc():  # switch to external clock source
                 cmd.close()
-                conf["baud"] = 1000000
-                cmd.open(conf["port"], conf["baud"])
+                conf.baud = 1000000
+                cmd.open(conf.port, conf.baud)
                 mdebug(
                     6,
                     "Opening port %(port)s, baud %(baud)d"
-                    % {"port": conf["port"], "baud": conf["baud"]},
+                    % {"port": conf.port, "baud": conf.baud},
                 )
                 mdebug(6, "Reconnecting to target at higher speed...")
                 if cmd.sendSynch() != 1:
@@ -190,35 +264,56 @@ def flash_firmware(port: str, firmware_path: str, exit_ = True) -> bool:
                     "source. (Try forcing speed)"
                 )
 
-        if conf["erase"]:
+        if (
+            conf.erase
+            and conf.write
+            and device.can_erase_range(conf.address, len(firmware_bytes))
+        ):
+            # only the pages the image covers
+            mdebug(5, "    Performing page erase")
+            if device.erase_range(conf.address, len(firmware_bytes)):
+                mdebug(5, "    Erase done")
+            else:
+                raise CmdException("Erase failed")
+        elif conf.erase:
             mdebug(5, "    Performing mass erase")
             if device.erase():
                 mdebug(5, "    Erase done")
             else:
                 raise CmdException("Erase failed")
 
-        if conf["erase_page"]:
-            erase_range = parse_page_address_range(device, conf["erase_page"])
+        if conf.erase_page:
+            erase_range = parse_page_address_range(device, conf.erase_page)
             mdebug(
                 5, "Erasing %d bytes at addres 0x%x" % (erase_range[1], erase_range[0])
             )
             cmd.cmdEraseMemory(erase_range[0], erase_range[1])
             mdebug(5, "    Partial erase done                  ")
 
-        if conf["write"]:
+        if conf.write:
             # TODO: check if boot loader back-door is open, need to read
             #       flash size first to get address
-            if cmd.writeMemory(conf["address"], firmware.bytes):
+            # fold the local CRC32 over each packet as it is sent
+            crc_written = 0
+
+            def fold_crc(chunk):
+                nonlocal crc_written
+                crc_written = zlib.crc32(chunk, crc_written)
+
+            if cmd.writeMemory(conf.address, firmware_bytes, on_chunk=fold_crc):
                 mdebug(5, "    Write done                                ")
             else:
                 raise CmdException("Write failed                       ")
 
-        if conf["verify"]:
+        if conf.verify:
             mdebug(5, "Verifying by comparing CRC32 calculations.")
 
-            crc_local = firmware.crc32()
+            if conf.write:
+                crc_local = crc_written
+            else:
+                crc_local = firmware.crc32()
             # CRC of target will change according to length input file
-            crc_target = device.crc(conf["address"], len(firmware.bytes))
+            crc_target = device.crc(conf.address, len(firmware_bytes))
 
             if crc_local == crc_target:
                 mdebug(5, "    Verified (match: 0x%08x)" % crc_local)
@@ -229,51 +324,43 @@ def flash_firmware(port: str, firmware_path: str, exit_ = True) -> bool:
                     "Target = 0x%x" % (crc_local, crc_target)
                 )
 
-        if conf["ieee_address"] != 0:
-            ieee_addr = parse_ieee_address(conf["ieee_address"])
+        if conf.ieee_address != 0:
+            ieee_addr = parse_ieee_address(conf.ieee_address)
             mdebug(
                 5,
-                "Setting IEEE address to %s"
-                % (":".join(["%02x" % b for b in struct.pack(">Q", ieee_addr)])),
+                "Setting IEEE address to "
+                "%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x"
+                % tuple(_BE_Q.pack(ieee_addr)),
             )
-            ieee_addr_bytes = struct.pack("<Q", ieee_addr)
+            ieee_addr_bytes = _LE_Q.pack(ieee_addr)
 
             if cmd.writeMemory(device.addr_ieee_address_secondary, ieee_addr_bytes):
                 mdebug(5, "    " "Set address done                                ")
             else:
                 raise CmdException("Set address failed                       ")
 
-        if conf["read"]:
-            length = conf["len"]
+        if conf.read:
+            length = conf.len
 
             # Round up to a 4-byte boundary
             length = (length + 3) & ~0x03
 
             mdebug(
                 5,
-                "Reading %s bytes starting at address 0x%x" % (length, conf["address"]),
+                "Reading %s bytes starting at address 0x%x" % (length, conf.address),
             )
-            with open(firmware_path, "wb") as f:
-                for i in range(0, length >> 2):
-                    # reading 4 bytes at a time
-                    rdata = device.read_memory(conf["address"] + (i * 4))
-                    mdebug(
-                        5,
-                        " 0x%x: 0x%02x%02x%02x%02x"
-                        % (
-                            conf["address"] + (i * 4),
-                            rdata[0],
-                            rdata[1],
-                            rdata[2],
-                            rdata[3],
-                        ),
-                        "\r",
-                    )
-                    f.write(rdata)
-                f.close()
+            data = device.read_memory_bulk(conf.address, length)
+            # one unbuffered write of the whole dump, no BufferedWriter copy
+            fd = os.open(firmware_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
             mdebug(5, "    Read done                                ")
 
-        if conf["disable-bootloader"]:
+        if conf.disable_bootloader:
             device.disable_bootloader()
 
         cmd.cmdReset()
@@ -1,5 +1,131 @@
-from dongle import __version__
+import pytest
+from intelhex import IntelHex
+
+from dongle import __version__, cc2538_bsl
+from dongle.cc2538_bsl import (
+    CC2538,
+    CmdException,
+    CommandInterface,
+    _read_intel_hex,
+)
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+class _EraseRecorder:
+    def __init__(self):
+        self.erased = []
+
+    def cmdEraseMemory(self, addr, size):
+        self.erased.append((addr, size))
+        return 1
+
+
+def _cc2538(size=0x80000):
+    # skip CC2538.__init__, it queries the chip over serial
+    device = CC2538.__new__(CC2538)
+    device.command_interface = _EraseRecorder()
+    device.flash_start_addr = 0x00200000
+    device.page_size = 2048
+    device.size = size
+    device.has_range_erase = True
+    return device
+
+
+def test_cc2538_erase_range_rounds_to_pages():
+    device = _cc2538()
+    device.erase_range(0x200000, 1)
+    device.erase_range(0x200100, 2048)
+    assert device.command_interface.erased == [(0x200000, 2048),
+                                               (0x200000, 4096)]
+
+
+def test_cc2538_range_erase_avoids_last_page():
+    device = _cc2538()
+    last_page = 0x200000 + 0x80000 - 2048
+    assert device.can_erase_range(0x200000, last_page - 0x200000)
+    assert not device.can_erase_range(0x200000, last_page - 0x200000 + 1)
+    assert not device.can_erase_range(0x200000, 0x80000)
+
+
+class _FakeSerial:
+    def __init__(self, replies):
+        self.replies = bytearray(replies)
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def read(self, length):
+        data = self.replies[:length]
+        del self.replies[:length]
+        return bytes(data)
+
+
+def test_send_data_is_one_packet():
+    cmd = CommandInterface()
+    # ACK for the data, ACK for GetStatus, status packet (COMMAND_RET_SUCCESS)
+    cmd.sp = _FakeSerial([0x00, 0xCC, 0x00, 0xCC, 0x03, 0x40, 0x40])
+    payload = bytes(range(1, 9))
+
+    assert cmd.cmdSendData(memoryview(payload))
+    assert cmd.sp.written[0] == (
+        bytes([len(payload) + 3, (0x24 + sum(payload)) & 0xFF, 0x24]) + payload)
+
+
+def test_read_intel_hex_matches_intelhex(tmp_path):
+    ih = IntelHex()
+    ih.puts(0x0100, bytes(range(40)))
+    ih.puts(0x0200, b"\x12\x34")  # gap padded with 0xFF
+    ih.puts(0x1fff0, bytes(range(32)))  # crosses a 0x04 base change
+    path = tmp_path / "fw.hex"
+    ih.write_hex_file(str(path))
+
+    assert _read_intel_hex(str(path)) == bytearray(IntelHex(str(path)).tobinarray())
+
+
+def _record(addr, rtype, data=b""):
+    rec = bytes([len(data), addr >> 8, addr & 0xFF, rtype]) + data
+    return ":%s%02X" % (rec.hex().upper(), -sum(rec) & 0xFF)
+
+
+@pytest.mark.parametrize("records", [
+    [":0100000001FF"],  # bad checksum
+    [_record(0, 0x04)],  # extended linear address without its 2 bytes
+    [_record(0, 0x05, b"\x00\x00")],  # start linear address too short
+    [_record(0, 0x03, b"\x00" * 5)],  # start segment address too long
+    [_record(0, 0x06)],  # unknown record type
+    [_record(0x10, 0x00, b"\x01" * 4),
+     _record(0x12, 0x00, b"\x02" * 4)],  # overlapping data
+])
+def test_read_intel_hex_rejects_bad_records(tmp_path, records):
+    path = tmp_path / "fw.hex"
+    path.write_text("\n".join(records + [":00000001FF"]) + "\n")
+
+    with pytest.raises(CmdException):
+        _read_intel_hex(str(path))
+
+
+class _NoLowLatencySerial:
+    # like pyserial's posix Serial on darwin/BSD
+    is_open = False
+
+    def open(self):
+        self.is_open = True
+
+    def set_low_latency_mode(self, low_latency_settings):
+        raise NotImplementedError(
+            "Low latency not supported on this platform")
+
+
+def test_open_without_low_latency_support(monkeypatch):
+    port = _NoLowLatencySerial()
+    monkeypatch.setattr(cc2538_bsl.serial, "serial_for_url",
+                        lambda *args, **kwargs: port)
+    cmd = CommandInterface()
+
+    cmd.open("/dev/cu.usbserial")
+    assert cmd.sp is port and port.is_open